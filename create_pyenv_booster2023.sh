@@ -28,6 +28,7 @@ else
     pip install opencv-python
     pip install cartopy
     pip install tqdm
+    pip install dask
     
     echo "Finished installing python packages"
     mkdir figures
@@ -21,6 +21,7 @@ import code
 
 import cartopy
 import matplotlib
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 matplotlib.rcParams['axes.linewidth'] = 0.1
 from mpl_toolkits.axes_grid1.inset_locator import inset_axes
@@ -40,33 +41,45 @@ ds_o = xr.Dataset( coords={ 'ml' : ds[ f'{field}/sample={i:05d}/ml' ][:],
                             'lat' : np.linspace( -90., 90., num=180*4+1, endpoint=True), 
                             'lon' : np.linspace( 0., 360., num=360*4, endpoint=False) } )
 nlevels = ds[ f'{field}/sample={i:05d}/ml' ].shape[0]
-ds_o['vo'] = (['ml', 'datetime', 'lat', 'lon'], np.zeros( ( nlevels, 6, 721, 1440)))
+ds_o['vo'] = (['ml', 'datetime', 'lat', 'lon'], np.zeros( ( nlevels, 6, 721, 1440), dtype=np.float32))
 
 # fill in local patches
-all_lats=[]
-all_lons=[]
+# patches are scattered via integer indices into the underlying numpy array (no xarray label lookup)
+vo_arr = ds_o['vo'].values
+dy, dx = 180. / (ds_o.lat.shape[0] - 1), 360. / ds_o.lon.shape[0]
 for i_str in ds[ f'{field}']:
-  if np.any(ds[ f'{field}/{i_str}/datetime' ][:]  != ds_o['vo'].datetime):
+  dt = ds[ f'{field}/{i_str}/datetime' ][:]
+  if np.any(dt != ds_o['vo'].datetime.values):
     break
-  ds_o['vo'].loc[ dict( datetime=ds[ f'{field}/{i_str}/datetime' ][:],
-        lat=ds[ f'{field}/{i_str}/lat' ][:],
-        lon=ds[ f'{field}/{i_str}/lon' ][:]) ] = ds[ f'{field}/{i_str}/data'][:] #[0, :]
+  lat, lon = ds[ f'{field}/{i_str}/lat' ][:], ds[ f'{field}/{i_str}/lon' ][:]
+  ti = np.arange( dt.shape[0])
+  yi = np.round( (lat + 90.) / dy).astype( np.int64)
+  xi = np.round( lon / dx).astype( np.int64)
+  # integer indexing does not validate coordinates (unlike label-based .loc) -> check explicitly
+  if not ( np.all( (yi >= 0) & (yi < ds_o.lat.shape[0])) and np.allclose( yi * dy - 90., lat) and
+           np.all( (xi >= 0) & (xi < ds_o.lon.shape[0])) and np.allclose( xi * dx, lon)) :
+    raise ValueError( f'Coordinates of patch {i_str} are not on the global grid.')
+  vo_arr[ (slice(None),) + np.ix_( ti, yi, xi) ] = ds[ f'{field}/{i_str}/data'][:] #[0, :]
 
 # plot and save the three time steps that form a token
 cmap = 'RdBu_r'
 vmin, vmax = ds_o['vo'].values[0].min(), ds_o['vo'].values[0].max()
 print(ds_o['datetime'].shape)
+# create figure, coastlines and colorbar once and only redraw the (re-projected) image per time step
+fig = plt.figure( figsize=(10,5), dpi=300)
+ax = plt.axes( projection=cartopy.crs.Robinson( central_longitude=0.))
+ax.add_feature( cartopy.feature.COASTLINE, linewidth=0.5, edgecolor='k', alpha=0.5)
+ax.set_global()
+sm = matplotlib.cm.ScalarMappable( norm=matplotlib.colors.Normalize( vmin=vmin, vmax=vmax), cmap=cmap)
+axins = inset_axes( ax, width="80%", height="5%", loc='lower center', borderpad=-2 )
+fig.colorbar( sm, cax=axins, orientation="horizontal")
+# frames of the lowest model level, flipped to north-up image orientation
+arr_stack = np.flip( ds_o['vo'].isel(ml=0).values, 1)
 for k in range( 6) :
-  fig = plt.figure( figsize=(10,5), dpi=300)
-  ax = plt.axes( projection=cartopy.crs.Robinson( central_longitude=0.))
-  ax.add_feature( cartopy.feature.COASTLINE, linewidth=0.5, edgecolor='k', alpha=0.5)
-  ax.set_global()
   date = ds_o['datetime'].values[k].astype('datetime64[m]')
   ax.set_title(f'{field} : {date}')
-  ds_o['vo'].isel(ml=0, datetime = k).plot.imshow(cmap=cmap, vmin=vmin, vmax=vmax)
-  im = ax.imshow( np.flip(ds_o['vo'].values[0,k], 0), cmap=cmap, vmin=vmin, vmax=vmax,
+  im = ax.imshow( arr_stack[k], cmap=cmap, vmin=vmin, vmax=vmax,
                   transform=cartopy.crs.PlateCarree( central_longitude=180.))
-  axins = inset_axes( ax, width="80%", height="5%", loc='lower center', borderpad=-2 )
-  fig.colorbar( im, cax=axins, orientation="horizontal")
-  plt.savefig( f'example_{k:03d}.png')
-  plt.close()
+  fig.savefig( f'example_{k:03d}.png')
+  im.remove()
+plt.close( fig)
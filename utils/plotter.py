@@ -19,6 +19,9 @@ import cartopy.feature as cfeature
 
 from utils.utils import get_units, field_full_name
 
+_CUSTOM_CMAP = mcolors.LinearSegmentedColormap.from_list('YlBu', 
+                  [ (0.278, 0.380, 0.620), (0.867, 0.647, 0.365), (0.991, 0.949, 0.765)], N=100)
+
 class Plotter(object):
     """
     Contains all basic plotting functions.
@@ -40,11 +43,10 @@ class Plotter(object):
 
     def CustomPalette(self):
         """
-        function to build a Mathematica-like palette
+        function to get the custom YlBu palette.
+        Note: the colormap is created once and shared; use .copy() before modifying it (e.g. set_bad, set_under).
         """
-        colors = [ (0.278, 0.380, 0.620), (0.867, 0.647, 0.365), (0.991, 0.949, 0.765)]
-        cmap = mcolors.LinearSegmentedColormap.from_list('YlBu', colors, N=100)
-        return cmap
+        return _CUSTOM_CMAP
     
 ######################################################
 
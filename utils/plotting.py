@@ -13,13 +13,13 @@ import logging
 import numpy as np
 import xarray as xr
 import pandas as pd
-from itertools import product
 
 # for plotting
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 mpl.rcParams['axes.linewidth'] = 0.1
 import matplotlib.colors as mcolors
+from PIL import Image
 
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 
@@ -34,13 +34,10 @@ module_name = os.path.basename(__file__).rstrip(".py")
 
 ########################################
 
-def CustomPalette():
-  colors = [ (0.278, 0.380, 0.620), (0.867, 0.647, 0.365), (0.991, 0.949, 0.765)]
-  cmap = mcolors.LinearSegmentedColormap.from_list('YlBu', colors, N=100)
-  return cmap
+_CUSTOM_CMAP = mcolors.LinearSegmentedColormap.from_list('YlBu', 
+                  [ (0.278, 0.380, 0.620), (0.867, 0.647, 0.365), (0.991, 0.949, 0.765)], N=100)
 
-def MathematicaPalette():
-  colors = [ 
+_MATH_COLORS = [ 
           (0.368417,	0.506779,	0.709798),
           (0.880722,	0.611041,	0.142051),
           (0.560181,	0.691569,	0.194885),
@@ -57,23 +54,27 @@ def MathematicaPalette():
           (0.736783,	0.358000,	0.503027),
           (0.280264,	0.715000,	0.429209)
           ]
-  cmap = mcolors.LinearSegmentedColormap.from_list('MathCol', colors, N=len(colors))
-  return cmap
+_MATH_CMAP = mcolors.LinearSegmentedColormap.from_list('MathCol', _MATH_COLORS, N=len(_MATH_COLORS))
+
+# colormaps are created once and shared among callers; use .copy() before modifying them (e.g. set_bad, set_under)
+def CustomPalette():
+  return _CUSTOM_CMAP
+
+def MathematicaPalette():
+  return _MATH_CMAP
 
 
 ########################################
    
 def create_canvas(figsize = (8, 8), ncols = 1, nrows = 1):  
-  fig, ax_temp = plt.subplots(figsize=(6, 6))
-  gs = fig.add_gridspec(ncols, nrows)
-  ax_temp.remove()
-  ax = [fig.add_subplot(gs[c,r]) for c,r in product(range(ncols), range(nrows))]
-  return fig, ax
+  # grid has ncols rows and nrows columns; axes are returned as flat list in row-major order
+  fig, ax = plt.subplots(ncols, nrows, figsize=figsize, squeeze=False)
+  return fig, list(ax.ravel())
 
 ########################################
 
 def imshow(data, ax, title = '', vmin=None, vmax=None, colorbar = False, remove_ticks = False):
-  im = ax.imshow(data, cmap=CustomPalette(), vmin=vmin, vmax=vmax)
+  im = ax.imshow(data, cmap=_CUSTOM_CMAP, vmin=vmin, vmax=vmax)
   ax.set_title(title, color='dimgray')
   if remove_ticks:
     ax.set_xticks([]), ax.set_yticks([])
@@ -153,30 +154,35 @@ def plot_1D_wDiff(field, data1, data2, label1, label2):
     # axs.append(fig1.add_subplot(gs[2,0]))
     data1_f = data1.flatten()
     data2_f = data2.flatten()
-    xmin = min(np.minimum(data1_f, data2_f))
-    xmax = max(np.maximum(data1_f, data2_f))
+    xmin = min(data1_f.min(), data2_f.min())
+    xmax = max(data1_f.max(), data2_f.max())
     
-    plt1 = axs[0].hist( data1_f, bins=50, fill=False, label = label1, range = [xmin, xmax], color='royalblue', histtype = 'step')
-    plt2 = axs[0].hist( data2_f, bins=50, fill=False, label = label2,  range= [xmin, xmax], color='red', histtype = 'step')
+    # uniform bins shared by both histograms: bin indices follow directly from scaling the data
+    nb = 50
+    bins = np.linspace(xmin, xmax, nb+1)
+    # degenerate range (constant data): all values fall into the first bin
+    scale = nb / (xmax - xmin) if xmax > xmin else 0.
+    h1, h2 = (np.bincount(np.clip(((d - xmin) * scale).astype(np.int32), 0, nb-1), minlength=nb) 
+              for d in (data1_f, data2_f))
+    axs[0].stairs(h1, bins, label = label1, color='royalblue')
+    axs[0].stairs(h2, bins, label = label2, color='red')
 
     axs[0].set_xlim([xmin, xmax])
     axs[0].legend(frameon=False)
     
     #ratio and diff plots 
-    width = (plt1[1][0] - plt1[1][-1])/len(plt1[1])
-    diff = (plt1[0]-plt2[0])-width
-    xvalues = plt1[1][:-1]-width
+    diff = h1 - h2
     axs[1].axhline(y=0., color='darkgray', linestyle='-', linewidth=0.5)
-    axs[1].bar(xvalues, height=diff,
-             width = width, align = 'edge')
+    axs[1].bar(bins[:-1], height=diff,
+             width = np.diff(bins), align = 'edge')
     axs[1].ticklabel_format(axis='y', style='sci', scilimits=(2,2))
     axs[1].set_ylabel(label1+"-"+label2)
     axs[1].set_xlim([xmin, xmax])
 
-    # ratio = np.divide(plt1[0], plt2[0])-width
+    # ratio = np.divide(h1, h2)
     # axs[2].axhline(y=1., color='darkgray', linestyle='-', linewidth=0.5)
-    # axs[2].bar(plt1[1][:-1], height=ratio, color = 'grey',alpha = 0.5, 
-    #          width= width , align = 'edge')
+    # axs[2].bar(bins[:-1], height=ratio, color = 'grey',alpha = 0.5, 
+    #          width= np.diff(bins) , align = 'edge')
     # axs[2].set_xlabel(field)
     # axs[2].set_ylabel(label1+"/"+label2)
     # axs[2].set_ylim([0, 2])
@@ -290,10 +296,13 @@ def save_ims( dir_out, field, data, name, min_val = 1., max_val = -1.) :
     max_val = data.max()
   print( 'min / max : {} / {}'.format( min_val, max_val) )
   print(data.min(), data.max())
+  # normalize and apply colormap only once, reused for both output formats
+  norm = mpl.colors.Normalize( vmin=min_val, vmax=max_val)
+  rgba = cmap( norm( data), bytes=True)
   bname = dir_out + '/fig_{}_{}.{}'
   fname = bname.format( field, name, 'png' )
-  plt.imsave( fname, data, vmin=min_val, vmax=max_val, cmap = cmap )
+  Image.fromarray( rgba).save( fname, compress_level=1)
   fname = bname.format( field, name, 'pdf' )
-  plt.imsave( fname, data, vmin=min_val, vmax=max_val, cmap = cmap )
+  plt.imsave( fname, rgba)
   plt.close()
     # print( 'Finished saving figures for step={}, tidx = {}.'.format( epoch, tidx) )
@@ -1,12 +1,20 @@
 import os
+import re
 import json
+import itertools
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 from tqdm import tqdm
 import zarr
+import dask.array
 import numpy as np
 import xarray as xr
 from pathlib import Path
 
+# epoch number in AtmoRep output file names, e.g. results_idc96xrbip_epoch00000_pred.zarr
+epoch_regex = re.compile(r"_epoch(\d+)")
+
 class HandleAtmoRepData(object):
     """
     Handle outout data of AtmoRep.
@@ -14,6 +22,7 @@ class HandleAtmoRepData(object):
     - support fixed location sampling
     """
     known_data_types = ["source", "pred", "target", "ens"]
+    token_config_keys = ("general_config", "vlevel", "num_tokens", "token_shape", "bert_parameters")
     
     def __init__(self, model_id: str, results_basedir: str = "/p/scratch/atmo-rep/results/",):
         """
@@ -29,8 +38,8 @@ class HandleAtmoRepData(object):
         self.input_variables = self._get_invars()
         self.target_variables = self._get_tarvars()
         
-        self.input_token_config = self.get_input_token_config()
-        self.target_token_config = self.get_target_token_config() 
+        # cache of file listings keyed by (results directory, pattern) (see _list_files)
+        self._file_cache = {}
         
     @property
     def results_dir(self):
@@ -83,23 +92,21 @@ class HandleAtmoRepData(object):
         :param key: key-string from which token-info is deducable
         :return dictionary of token info
         """
-        token_config_keys = ["general_config", "vlevel", "num_tokens", "token_shape", "bert_parameters"]
-        token_config = {var[0]: None for var in self.config[key]}        
-        for i, var in enumerate(token_config):
-            len_config = len(self.config[key][i])
-            token_config[var] =  {config_key: self.config[key][i][j+1] for j, config_key in enumerate(token_config_keys)}
-        
-        return token_config
+        # strict zip: fail on config entries with too few values (further entries are ignored)
+        nkeys = len(self.token_config_keys)
+        return {var[0]: dict(zip(self.token_config_keys, var[1:nkeys+1], strict=True)) for var in self.config[key]}
     
-    def get_input_token_config(self) -> dict:
+    @functools.cached_property
+    def input_token_config(self) -> dict:
         """
-        Get input token configuration
+        Input token configuration (computed once since the model configuration is read-only).
         """
         return self._get_token_config("fields")
-        
-    def get_target_token_config(self) -> dict:
+    
+    @functools.cached_property
+    def target_token_config(self) -> dict:
         """
-        Retrieve token configuration of output/target data.
+        Token configuration of output/target data.
         Note that the token configuration is the same as the input data as long as target_fields is unset.
         """
         if self.target_type in ["target_fields", "fields_targets"]:
@@ -107,40 +114,67 @@ class HandleAtmoRepData(object):
         else:
             return self.input_token_config
     
+    def get_input_token_config(self) -> dict:
+        """
+        Get input token configuration
+        """
+        return self.input_token_config
+        
+    def get_target_token_config(self) -> dict:
+        """
+        Retrieve token configuration of output/target data.
+        """
+        return self.target_token_config
     
-    def read_one_forecast_file(self, fname: str, varname: str, data_type: str):
+    
+    def read_one_forecast_file(self, fname: str, varname: str, data_type: str, progress: bool = True):
         """
         Read data from a single output file of AtmoRep and convert to xarray DataArray with underlying coordinate information.
+        All patches of the file are stacked along the patch-dimension such that only one DataArray is created per file.
         :param fname: Name of zarr-file that should be read
         :param varname: name of variable in zarr-file to be accessed
         :param data_type: Type of data which should be retrieved (either 'source', 'target', 'ens' or 'pred')
-        :return: list of DataArrays where each element provides one sample
+        :param progress: flag to show progress bar over patches
+        :return: list with one DataArray of dimensions (patch, [ensemble,] ml, t, y, x) where datetime, lat and lon 
+                 are provided as (patch, t), (patch, y) and (patch, x) coordinates, respectively
         """    
-        store = zarr.ZipStore(fname)
+        store = zarr.ZipStore(fname, mode="r")
         grouped_store = zarr.group(store)
             
-        dims = ["ml", "datetime", "lat", "lon"]
+        dims = ["patch", "ml", "t", "y", "x"]
+        coords = {}
         if data_type == "ens":
             nens = self.config["net_tail_num_nets"]
-            coords = {"ensemble": range(nens)}
-        else:
-            coords = {}
+            coords["ensemble"] = range(nens)
+            dims.insert(1, "ensemble")
             
-        da = []
-        for ip, patch in tqdm(enumerate(grouped_store[os.path.join(varname)])):    
-            coords.update({dim: grouped_store[os.path.join(varname, patch, dim)] for dim in dims})
-            da_p = xr.DataArray(grouped_store[os.path.join(varname, patch, "data")], coords=coords,                
-                                dims = ["ensemble"] + dims if data_type == "ens" else dims, name=f"{varname}_{patch.replace('=', '')}")
-            da.append(da_p)
+        patch_list, data_list, dt_list, lat_list, lon_list = [], [], [], [], []
+        field_group = grouped_store[varname]
+        for patch, patch_group in tqdm(field_group.groups(), disable=not progress):
+            # wrap zarr array with dask to keep data access lazy (xarray would load it into memory otherwise)
+            data = patch_group["data"]
+            # deterministic name skips dask's tokenization (pickling) of the zarr array
+            data_list.append(dask.array.from_array(data, chunks=data.chunks, name=f"{fname}:{varname}/{patch}"))
+            # read (small) coordinate arrays in one shot from the patch group
+            dt_list.append(patch_group["datetime"][:])
+            lat_list.append(patch_group["lat"][:])
+            lon_list.append(patch_group["lon"][:])
+            patch_list.append(patch)
+            if "ml" not in coords:
+                coords["ml"] = patch_group["ml"][:]
         
-        # ML: This would trigger loading data into memory rather than lazy data access.
-        #da = xr.concat(da, "patch")
+        if len(patch_list) == 0:
+            return []
         
-        return da
+        coords.update({"patch": patch_list, "datetime": (("patch", "t"), np.stack(dt_list)), 
+                       "lat": (("patch", "y"), np.stack(lat_list)), "lon": (("patch", "x"), np.stack(lon_list))})
+        da = xr.DataArray(dask.array.stack(data_list, axis=0), coords=coords, dims=dims, name=varname)
+        
+        return [da]
     
-    def read_one_bert_file(self, fname: str, varname: str, data_type: str, ml: int):
+    def read_one_bert_file(self, fname: str, varname: str, data_type: str, ml: int, progress: bool = True):
         
-        store = zarr.ZipStore(fname)
+        store = zarr.ZipStore(fname, mode="r")
         grouped_store = zarr.group(store)
         
         dims = ["itoken", "t", "y", "x"]
@@ -150,28 +184,29 @@ class HandleAtmoRepData(object):
             
         da = []
             
-        for ip, patch in tqdm(enumerate(grouped_store[os.path.join(varname)])):
-            data_coords = {dim: (dim_map, grouped_store[os.path.join(varname, patch, f"ml={ml:d}", dim)]) for dim, dim_map in dims_map.items()}
-            data = grouped_store[os.path.join(varname, patch, f"ml={ml:d}", "data")]
-            data_sh = data.shape
-            _ = [data_coords.update({dim: range(data_sh[i]) for i, dim in enumerate(dims)})]
+        for patch in tqdm(grouped_store[varname], disable=not progress):
+            # look up the level group once and read all arrays from it
+            level_group = grouped_store[f"{varname}/{patch}/ml={ml:d}"]
+            data = level_group["data"][:]
+            data_coords = {dim: (dim_map, level_group[dim][:]) for dim, dim_map in dims_map.items()}
+            data_coords.update({dim: range(data.shape[i]) for i, dim in enumerate(dims)})
 
-            da_p = xr.DataArray(grouped_store[os.path.join(varname, patch, f"ml={ml:d}", "data")], 
-                                coords=data_coords, dims = dims, name=f"{varname}_ml{ml:d}_{patch.replace('=', '')}")
+            da_p = xr.DataArray(data, coords=data_coords, dims = dims, name=f"{varname}_ml{ml:d}_{patch.replace('=', '')}")
             da.append(da_p)
 
         return da
     
-    def read_data(self, varname: str, data_type, epoch: int = -1, **kwargs):
+    def read_data(self, varname: str, data_type, epoch: int = -1, refresh_files: bool = False, **kwargs):
         """
         Read data from a single output file of AtmoRep and convert to xarray DataArray with underlying coordinate information.
         :param varname: name of variable for which token info is requested
         :param data_type: Type of data which should be retrieved (either 'source', 'target', 'ens' or 'pred')
         :param epoch: training epoch of requested token information file
+        :param refresh_files: flag to search the results directory again instead of using the cached file listing
         """                  
         assert data_type in self.known_data_types, f"Data type '{data_type}' is unknown. Chosse one of the following: '{', '.join(self.known_data_types)}'"
         
-        filelist = self.get_hierarchical_sorted_files(data_type, epoch)
+        filelist = self.get_hierarchical_sorted_files(data_type, epoch, refresh=refresh_files)
         
         if self.config["BERT_strategy"] == "forecast":
             self.read_one_file = self.read_one_forecast_file
@@ -188,9 +223,13 @@ class HandleAtmoRepData(object):
             print(f"Handling data with sampling strategy '{self.config['BERT_strategy']}' is not supported yet.")
         
         print(f"Start reading {len(filelist)} files...")
-        da = []
-        for i, f in enumerate(filelist):
-            da += self.read_one_file(f, **args)
+        # read files concurrently (I/O-bound, zarr decompression releases the GIL), ex.map preserves file order;
+        # this speeds up the eager reads of the BERT path and the coordinate/metadata reads, whereas forecast patch 
+        # data stays lazy (dask) and is decompressed later, e.g. in get_global_field
+        # progress is only reported over files since per-file progress bars of concurrent workers would interfere
+        with ThreadPoolExecutor(max_workers=min(16, len(filelist))) as ex:
+            results = list(tqdm(ex.map(lambda f: self.read_one_file(f, progress=False, **args), filelist), total=len(filelist)))
+        da = list(itertools.chain.from_iterable(results))
             
         # return global data if global forecasting evaluation mode was chosen 
         # ML: preliminary approach: identification via token_overlap-attribute 
@@ -201,53 +240,87 @@ class HandleAtmoRepData(object):
     
     @staticmethod
     def get_global_field(da_list):
-        
+        """
+        Assemble global data field from the patches of a global forecast.
+        :param da_list: list of DataArrays with stacked patches as returned by read_one_forecast_file
+        :return: DataArray with dimensions ([ensemble,] ml, datetime, lat, lon)
+        """
         # get unique time stamps
-        times_unique = list(set([time for da in da_list for time in da["datetime"].values]))
-        dx, dy = np.abs(da_list[0]["lon"][1] - da_list[0]["lon"][0]), \
-                 np.abs(da_list[0]["lat"][1] - da_list[0]["lat"][0])
+        times_unique = np.unique(np.concatenate([da["datetime"].values.ravel() for da in da_list]))
+        lon0, lat0 = da_list[0]["lon"].values[0], da_list[0]["lat"].values[0]
+        dx, dy = float(np.abs(lon0[1] - lon0[0])), float(np.abs(lat0[1] - lat0[0]))
         
         # initialize empty global data array
-        dims = da_list[0].dims
-        data_coords = {k: v for k, v in da_list[0].coords.items() if k not in ["lat", "lon"]}
+        lead_dims = [dim for dim in da_list[0].dims if dim not in ["patch", "t", "y", "x"]]
+        data_coords = {dim: da_list[0][dim].values for dim in lead_dims}
+        data_coords["datetime"] = times_unique
         data_coords["lat"] = np.linspace(-90., 90., num=int(180/dy) + 1, endpoint=True)
         data_coords["lon"] = np.linspace(0, 360, num=int(360/dx), endpoint=False)  
-        data_coords["datetime"] = times_unique
 
-        da_global = xr.DataArray(np.empty(tuple(len(d) for d in data_coords.values())), 
-                                 coords=data_coords, dims=dims)
+        # all non-spatiotemporal dimensions (e.g. ml, ensemble) are flattened into one leading axis
+        # such that the patches can be copied into a plain 4D numpy buffer
+        lead_shape = tuple(len(data_coords[dim]) for dim in lead_dims)
+        nlat, nlon = len(data_coords["lat"]), len(data_coords["lon"])
+        # single precision suffices for analysis and halves memory (traffic) of the global field
+        buf = np.empty((int(np.prod(lead_shape)), len(times_unique), nlat, nlon), dtype=np.float32)
+        
+        # coverage bitmap over (datetime, lat, lon) to detect grid points not filled by any patch
+        covered = np.zeros(buf.shape[1:], dtype=bool)
+        t_map = {time: i for i, time in enumerate(times_unique)}
+        
         # fill global data array 
         for da in da_list:
-            da_global.loc[{"datetime": da["datetime"], "lat": da["lat"], "lon": da["lon"]}] = da
+            data = da.transpose("patch", *lead_dims, "t", "y", "x").values.astype(np.float32, copy=False)
+            for data_p, dt_p, lat_p, lon_p in zip(data, da["datetime"].values, da["lat"].values, da["lon"].values):
+                ti = np.fromiter((t_map[time] for time in dt_p), dtype=np.int64)
+                yi = np.round((lat_p + 90.)/dy).astype(np.int64)
+                xi = np.round(lon_p/dx).astype(np.int64)
+                # integer indexing does not validate coordinates (unlike label-based indexing) -> check explicitly
+                if not (np.all((yi >= 0) & (yi < nlat)) and np.allclose(yi*dy - 90., lat_p) and 
+                        np.all((xi >= 0) & (xi < nlon)) and np.allclose(xi*dx, lon_p)):
+                    raise ValueError(f"Could not get global data field.")
+                buf[(slice(None),) + np.ix_(ti, yi, xi)] = data_p.reshape(buf.shape[0], len(ti), len(yi), len(xi))
+                covered[np.ix_(ti, yi, xi)] = True
 
-        if np.any(da_global.isnull()): 
+        if not covered.all(): 
             raise ValueError(f"Could not get global data field.")
+
+        da_global = xr.DataArray(buf.reshape(lead_shape + buf.shape[1:]), coords=data_coords, 
+                                 dims=lead_dims + ["datetime", "lat", "lon"])
             
         return da_global                      
     
         
-    def get_hierarchical_sorted_files(self, data_type: str, epoch: int = -1):
+    def get_hierarchical_sorted_files(self, data_type: str, epoch: int = -1, refresh: bool = False):
         """
         Get sorted list of file names.
         :param data_type: Type of data which should be retrieved (either 'source', 'target', 'ens' or 'pred')
         :param epoch: number of epoch for which data should be retrieved. Parse -1 for getting all epochs.
+        :param refresh: flag to search the results directory again (e.g. to pick up files of newly written epochs)
         """
         epoch_str = f"epoch*" if epoch == -1 else f"epoch{epoch:05d}"
         
         fpatt = f"results_{self.model_id}_{epoch_str}_{data_type}.zarr"
-        filelist = list(Path(self.results_dir).glob(f"**/{fpatt}"))
+        filelist = self._list_files(fpatt, refresh=refresh)
         
         if len(filelist) == 0:
             raise FileNotFoundError(f"Could not file any files mathcing pattern '{fpatt}' under directory '{self.results_dir}'.")
         
         # hierarchical sorting: epoch -> rank -> batch
-        sorted_filelist = sorted(filelist, key=lambda x: self.get_number(x, "_epoch"))
+        keyed_filelist = sorted((int(epoch_regex.search(f.name).group(1)), f) for f in filelist)
       
-        return sorted_filelist
+        return [f for _, f in keyed_filelist]
     
-    @staticmethod
-    def get_number(file_name, split_arg):
-        # Extract the number from the file name using the provided split argument
-        return int(str(file_name).split(split_arg)[1].split('_')[0])  
-
-    
\ No newline at end of file
+    def _list_files(self, pattern: str, refresh: bool = False):
+        """
+        Recursively search results directory for files matching pattern. 
+        Results are cached per instance since the (recursive) search is performed for every call to read_data.
+        :param pattern: glob-pattern of file names
+        :param refresh: flag to search again and update the cached listing
+        :return: tuple of matching file paths
+        """
+        key = (self.results_dir, pattern)
+        if refresh or key not in self._file_cache:
+            self._file_cache[key] = tuple(self.results_dir.glob(f"**/{pattern}"))
+        
+        return self._file_cache[key]